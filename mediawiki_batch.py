@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+import logging
+logger = logging.getLogger("mwparser.batch")
+
+import os
+import time
+import json
+import codecs
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase
+
+from mediawiki_token import tokenize, tokens
+from mediawiki_processor import MWProcessor, plaintext
+from mediawiki_output import ShardedWriter, CheckpointMismatch, read_manifest
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        return json.load(f)
+
+def save_checkpoint(path, checkpoint):
+    '''Atomically replace the checkpoint at path.'''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        json.dump(checkpoint, f, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+
+class BatchRunner(object):
+    '''Process a list of input pages into shards, resumably.
+
+    Checkpoints are taken at shard boundaries: after every
+    checkpoint_every shards have been compressed and recorded in the
+    manifest, a checkpoint with the number of inputs those shards cover,
+    the last page id, the writer state and running stats is written.
+    Tokenization never waits for a checkpoint. A later run with the same
+    inputs and checkpoint path skips the finished inputs and rolls the
+    output back to the checkpoint, so no page is written twice.
+    '''
+
+    def __init__(self, inputs, output_dir, checkpoint_path=None,
+                 checkpoint_every=1, **writer_options):
+        if checkpoint_every < 1:
+            raise ValueError("checkpoint_every must be at least 1, not %r" %
+                             checkpoint_every)
+        self.inputs = list(inputs)
+        self.output_dir = output_dir
+        if checkpoint_path is None:
+            checkpoint_path = os.path.join(output_dir, u'checkpoint.json')
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.writer_options = writer_options
+        self.processor = MWProcessor()
+
+    def read_page(self, item):
+        with codecs.open(item, 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def process_page(self, contents):
+        return u''.join(plaintext(self.processor.process(tokenize(contents, tokens()))))
+
+    def run(self):
+        checkpoint = load_checkpoint(self.checkpoint_path)
+        if checkpoint is None:
+            position = 0
+            state = None
+            stats = {'pages': 0, 'characters': 0, 'seconds': 0.0}
+        else:
+            position = checkpoint['position']
+            state = checkpoint['writer']
+            stats = checkpoint['stats']
+            if position > len(self.inputs) or \
+                    (position > 0 and self.inputs[position - 1] != checkpoint['page']):
+                raise CheckpointMismatch("Checkpoint %s does not match the inputs" %
+                                         self.checkpoint_path)
+            logger.info("Resuming after %i of %i pages", position, len(self.inputs))
+
+        self.commits = 0
+        self.unsaved = None
+        writer = self.writer = ShardedWriter(self.output_dir, state=state,
+                                             on_commit=self._on_commit,
+                                             **self.writer_options)
+        start = time.time()
+        seconds = stats['seconds']
+
+        try:
+            while position < len(self.inputs):
+                item = self.inputs[position]
+                text = self.process_page(self.read_page(item))
+                position += 1
+                stats['pages'] += 1
+                stats['characters'] += len(text)
+                stats['seconds'] = seconds + time.time() - start
+                writer.write_page(item, text, mark={'position': position,
+                                                    'page': item,
+                                                    'stats': dict(stats)})
+        except:
+            # Work past the last checkpoint is redone on resume, so don't
+            # spend time compressing it or let a writer error mask this one.
+            writer.close(discard=True)
+            raise
+        writer.close()
+
+        if self.unsaved is not None:
+            save_checkpoint(self.checkpoint_path, self.unsaved)
+        return stats
+
+    def _on_commit(self, mark, state):
+        checkpoint = dict(mark, writer=state)
+        self.commits += 1
+        if self.commits % self.checkpoint_every == 0:
+            save_checkpoint(self.checkpoint_path, checkpoint)
+            self.unsaved = None
+        else:
+            self.unsaved = checkpoint
+
+
+#
+# Tests
+#
+class _FailingRunner(BatchRunner):
+    def __init__(self, fail_at, *args, **kwargs):
+        super(_FailingRunner, self).__init__(*args, **kwargs)
+        self.fail_at = fail_at
+
+    def read_page(self, item):
+        if item == self.fail_at:
+            # Let every finished shard commit so the checkpoint is predictable.
+            self.writer.flush()
+            raise KeyboardInterrupt()
+        return super(_FailingRunner, self).read_page(item)
+
+
+class _RecordingRunner(BatchRunner):
+    def __init__(self, *args, **kwargs):
+        super(_RecordingRunner, self).__init__(*args, **kwargs)
+        self.read = []
+
+    def read_page(self, item):
+        self.read.append(item)
+        return super(_RecordingRunner, self).read_page(item)
+
+
+class BatchRunnerTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.out = os.path.join(self.dir, u'out')
+        self.inputs = []
+        for i in range(7):
+            path = os.path.join(self.dir, u'page%i.txt' % i)
+            with codecs.open(path, 'w', encoding='utf-8') as f:
+                f.write(u"Page '''%i''' [[foo|bar]]." % i)
+            self.inputs.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def manifest(self):
+        return list(read_manifest(os.path.join(self.out, u'shard.manifest')))
+
+    def test_run(self):
+        stats = BatchRunner(self.inputs, self.out, checkpoint_every=3).run()
+        self.assertEqual(stats['pages'], 7)
+        self.assertEqual([m[0] for m in self.manifest()], self.inputs)
+        self.assertEqual(load_checkpoint(os.path.join(self.out, u'checkpoint.json'))['position'], 7)
+
+    def test_checkpoints_do_not_cut_shards(self):
+        BatchRunner(self.inputs, self.out, checkpoint_every=1).run()
+        shards = [n for n in os.listdir(self.out) if n.endswith('.gz')]
+        self.assertEqual(len(shards), 1)
+
+    def test_resume_after_crash(self):
+        runner = _FailingRunner(self.inputs[5], self.inputs, self.out,
+                                checkpoint_every=2, shard_size=10)
+        self.assertRaises(KeyboardInterrupt, runner.run)
+        checkpoint = load_checkpoint(runner.checkpoint_path)
+        self.assertEqual(checkpoint['position'], 4)
+
+        runner = _RecordingRunner(self.inputs, self.out, checkpoint_every=2,
+                                  shard_size=10)
+        stats = runner.run()
+        self.assertEqual(runner.read, self.inputs[4:])
+        self.assertEqual(stats['pages'], 7)
+        self.assertEqual([m[0] for m in self.manifest()], self.inputs)
+        shards = [n for n in os.listdir(self.out) if n.endswith('.gz')]
+        self.assertEqual(len(shards), 7)
+
+    def test_changed_compression(self):
+        BatchRunner(self.inputs[:3], self.out, shard_size=10).run()
+        runner = BatchRunner(self.inputs, self.out, shard_size=10,
+                             compression='bz2')
+        self.assertRaises(CheckpointMismatch, runner.run)
+
+    def test_invalid_checkpoint_every(self):
+        self.assertRaises(ValueError, BatchRunner, self.inputs, self.out,
+                          checkpoint_every=0)
+
+    def test_mismatched_inputs(self):
+        BatchRunner(self.inputs[:3], self.out).run()
+        runner = BatchRunner(self.inputs[1:], self.out)
+        self.assertRaises(CheckpointMismatch, runner.run)
+
+
+if __name__ == '__main__':
+    unittest.main()
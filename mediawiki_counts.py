@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+
+import logging
+logger = logging.getLogger("mwparser.counts")
+
+import os
+import sys
+import codecs
+import heapq
+import shutil
+import tempfile
+import unittest
+from unittest import TestCase
+from collections import defaultdict, deque
+from itertools import groupby
+from operator import itemgetter
+
+from mediawiki_token import tokenize, tokens, Word, Space, NewLine, Punctuation, Pipe
+from mediawiki_processor import MWProcessor, y
+
+
+def read_counts(path):
+    '''Yield (key, count) pairs from a key-sorted counts file.'''
+    with open(path, 'rb') as f:
+        for line in f:
+            key, count = line.decode('utf-8').rstrip(u'\n').split(u'\t')
+            yield key, int(count)
+
+def write_counts(path, items):
+    with open(path, 'wb') as f:
+        for key, count in items:
+            f.write((u'%s\t%i\n' % (key, count)).encode('utf-8'))
+
+def merge_counts(streams):
+    '''Merge key-sorted (key, count) streams, summing counts of equal keys.'''
+    for key, group in groupby(heapq.merge(*streams), key=itemgetter(0)):
+        yield key, sum(count for _, count in group)
+
+def merge_files(paths, out_path):
+    write_counts(out_path, merge_counts([read_counts(p) for p in paths]))
+
+
+class WordCounter(object):
+    '''Count words and word n-grams from a processed token stream.
+
+    Counts are kept in memory until max_entries distinct keys are held,
+    at which point they are spilled to a sorted run file in spill_dir and
+    the in-memory table is cleared. Runs are merged in tiers: once
+    max_runs runs of one tier exist they are merged into a single run of
+    the next tier, so each count is rewritten only once per tier and no
+    merge opens more than max_runs files. items() merges the runs back
+    together, so memory use stays bounded by max_entries regardless of
+    vocabulary size. Saved counts files are key-sorted and can be
+    combined with merge_files(), which is how per-worker partial counts
+    are merged.
+
+    N-grams of every order from 1 to ngram are counted; they span only
+    Space tokens, so any other token (NewLine, Punctuation, Pipe, URL and
+    so on) starts a new window. Markup that the processor removed
+    entirely (templates, references, link targets) leaves no token
+    behind, so words on either side of it still form n-grams.
+    '''
+
+    def __init__(self, lowercase=False, ngram=1, max_entries=1000000,
+                 spill_dir=None, max_runs=64):
+        if max_entries < 1:
+            raise ValueError("max_entries must be at least 1, not %r" % max_entries)
+        if max_runs < 2:
+            raise ValueError("max_runs must be at least 2, not %r" % max_runs)
+        self.lowercase = lowercase
+        self.ngram = ngram
+        self.max_entries = max_entries
+        self.spill_dir = spill_dir
+        self.max_runs = max_runs
+        self.counts = defaultdict(int)
+        # (tier, path) pairs
+        self.runs = []
+
+    def add_tokens(self, token_stream):
+        window = deque(maxlen=self.ngram)
+        counts = self.counts
+        for token in token_stream:
+            if isinstance(token, Space):
+                continue
+            if not isinstance(token, Word):
+                window.clear()
+                continue
+
+            word = token.text.lower() if self.lowercase else token.text
+            window.append(word)
+            words = list(window)
+            for n in range(1, len(words) + 1):
+                counts[u' '.join(words[-n:])] += 1
+
+            if len(counts) >= self.max_entries:
+                self.spill()
+                counts = self.counts
+
+    def spill(self):
+        if not self.counts:
+            return
+        path = self._run_path()
+        write_counts(path, sorted(self.counts.iteritems()))
+        logger.debug("Spilled %i entries to %s", len(self.counts), path)
+        self.counts = defaultdict(int)
+        self._add_run(0, path)
+
+    def _add_run(self, tier, path):
+        self.runs.append((tier, path))
+        if len([t for t, _ in self.runs if t == tier]) >= self.max_runs:
+            self._merge_tier(tier)
+
+    def _merge_tier(self, tier):
+        paths = [p for t, p in self.runs if t == tier]
+        self.runs = [(t, p) for t, p in self.runs if t != tier]
+        path = self._run_path()
+        merge_files(paths, path)
+        logger.debug("Merged %i tier %i runs into %s", len(paths), tier, path)
+        for run in paths:
+            os.remove(run)
+        self._add_run(tier + 1, path)
+
+    def _run_path(self):
+        fd, path = tempfile.mkstemp(prefix='counts-', suffix='.tsv',
+                                    dir=self.spill_dir)
+        os.close(fd)
+        return path
+
+    def items(self):
+        '''Yield all (key, count) pairs in key order.'''
+        # Runs left over in several tiers can exceed max_runs in total;
+        # fold the lowest tiers up until they can all be opened at once.
+        while len(self.runs) > self.max_runs:
+            self._merge_tier(min(t for t, _ in self.runs))
+        streams = [read_counts(p) for _, p in self.runs]
+        streams.append(sorted(self.counts.iteritems()))
+        return merge_counts(streams)
+
+    def save(self, path):
+        write_counts(path, self.items())
+
+    def close(self):
+        for _, path in self.runs:
+            os.remove(path)
+        self.runs = []
+        self.counts = defaultdict(int)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+
+def count_files(paths, out_path, **counter_options):
+    '''Count the processed contents of paths into out_path.'''
+    processor = MWProcessor()
+    with WordCounter(**counter_options) as counter:
+        for path in paths:
+            with codecs.open(path, 'r', encoding='utf-8') as f:
+                contents = f.read()
+            counter.add_tokens(processor.process(tokenize(contents, tokens())))
+        counter.save(out_path)
+    return out_path
+
+def _count_files_star(args):
+    paths, out_path, counter_options = args
+    return count_files(paths, out_path, **counter_options)
+
+
+#
+# Tests
+#
+class WordCounterTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_words(self):
+        data = [Word(u"Foo"), Word(u"bar"), NewLine(u'\n'), Word(u"foo")]
+        with WordCounter() as c:
+            c.add_tokens(y(data))
+            self.assertEqual(list(c.items()), [(u'Foo', 1), (u'bar', 1), (u'foo', 1)])
+        with WordCounter(lowercase=True) as c:
+            c.add_tokens(y(data))
+            self.assertEqual(list(c.items()), [(u'bar', 1), (u'foo', 2)])
+
+    def test_ngrams(self):
+        data = [Word(u"a"), Word(u"b"), Word(u"c"), NewLine(u'\n'), Word(u"d")]
+        with WordCounter(ngram=2) as c:
+            c.add_tokens(y(data))
+            self.assertEqual(dict(c.items()), {u'a': 1, u'b': 1, u'c': 1, u'd': 1,
+                                               u'a b': 1, u'b c': 1})
+
+    def test_spill(self):
+        data = [Word(w) for w in u"a b a c b a d".split()]
+        with WordCounter(max_entries=2, spill_dir=self.dir) as c:
+            c.add_tokens(y(data))
+            self.assertTrue(len(c.runs) > 1)
+            self.assertEqual(list(c.items()),
+                             [(u'a', 3), (u'b', 2), (u'c', 1), (u'd', 1)])
+
+    def test_ngrams_stop_at_punctuation(self):
+        data = [Word(u"end"), Punctuation(u"."), Space(u" "), Word(u"Next")]
+        with WordCounter(ngram=2) as c:
+            c.add_tokens(y(data))
+            self.assertEqual(dict(c.items()), {u'end': 1, u'Next': 1})
+
+    def test_spill_fan_in(self):
+        data = [Word(w) for w in u"a b c d e f a".split()]
+        with WordCounter(max_entries=1, max_runs=3, spill_dir=self.dir) as c:
+            c.add_tokens(y(data))
+            self.assertEqual(sorted(t for t, _ in c.runs), [0, 1, 1])
+            self.assertEqual(dict(c.items()), {u'a': 2, u'b': 1, u'c': 1,
+                                               u'd': 1, u'e': 1, u'f': 1})
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_spill_tiers(self):
+        data = [Word(w) for w in u"a b c d e f g h i j".split()]
+        with WordCounter(max_entries=1, max_runs=3, spill_dir=self.dir) as c:
+            c.add_tokens(y(data))
+            # Nine spills fold into one tier 2 run; the tenth stays at tier 0.
+            self.assertEqual(sorted(t for t, _ in c.runs), [0, 2])
+            self.assertEqual(len(list(c.items())), 10)
+
+    def test_ngrams_stop_at_other_tokens(self):
+        data = [Word(u"bar"), Space(u" "), Pipe(u"|"), Space(u" "), Word(u"qux")]
+        with WordCounter(ngram=2) as c:
+            c.add_tokens(y(data))
+            self.assertEqual(dict(c.items()), {u'bar': 1, u'qux': 1})
+
+    def test_invalid_settings(self):
+        self.assertRaises(ValueError, WordCounter, max_entries=0)
+        self.assertRaises(ValueError, WordCounter, max_runs=1)
+
+    def test_merge_files(self):
+        parts = []
+        for i, text in enumerate([u"x y", u"y z"]):
+            path = os.path.join(self.dir, u'part%i.tsv' % i)
+            with WordCounter() as c:
+                c.add_tokens(y([Word(w) for w in text.split()]))
+                c.save(path)
+            parts.append(path)
+        out = os.path.join(self.dir, u'merged.tsv')
+        merge_files(parts, out)
+        self.assertEqual(list(read_counts(out)), [(u'x', 1), (u'y', 2), (u'z', 1)])
+
+    def test_count_files(self):
+        path = os.path.join(self.dir, u'page.txt')
+        with codecs.open(path, 'w', encoding='utf-8') as f:
+            f.write(u"Hyvä '''sana''' {{malline}} [[sana]].")
+        out = count_files([path], os.path.join(self.dir, u'out.tsv'))
+        self.assertEqual(list(read_counts(out)), [(u'Hyvä', 1), (u'sana', 2)])
+
+
+if __name__ == '__main__':
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="%prog [options] FILE...")
+    parser.add_option("-o", "--output", dest="output",
+                      help="write merged counts to FILE", metavar="FILE")
+    parser.add_option("-l", "--lowercase", dest="lowercase",
+                      help="lowercase words before counting",
+                      action="store_true", default=False)
+    parser.add_option("-n", "--ngram", dest="ngram", type="int",
+                      help="count n-grams up to this order", default=1)
+    parser.add_option("--max-entries", dest="max_entries", type="int",
+                      help="in-memory entries per worker before spilling",
+                      default=1000000)
+    parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                      help="parallel worker processes", default=1)
+    parser.add_option("-m", "--merge", dest="merge",
+                      help="inputs are counts files to merge",
+                      action="store_true", default=False)
+    (opts, args) = parser.parse_args()
+
+    if len(args) == 0:
+        unittest.main()
+    if opts.output is None:
+        parser.error("--output is required")
+    if opts.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if opts.ngram < 1:
+        parser.error("--ngram must be at least 1")
+    if opts.max_entries < 1:
+        parser.error("--max-entries must be at least 1")
+
+    if opts.merge:
+        merge_files(args, opts.output)
+        sys.exit(0)
+
+    counter_options = {'lowercase': opts.lowercase, 'ngram': opts.ngram,
+                       'max_entries': opts.max_entries}
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(opts.output)))
+    try:
+        jobs = [(args[i::opts.jobs], os.path.join(tmp_dir, u'part%i.tsv' % i),
+                 dict(counter_options, spill_dir=tmp_dir))
+                for i in range(min(opts.jobs, len(args)))]
+        if len(jobs) == 1:
+            parts = [_count_files_star(jobs[0])]
+        else:
+            from multiprocessing import Pool
+            pool = Pool(len(jobs))
+            try:
+                # map_async().get() with a timeout, unlike map(), lets
+                # Ctrl-C through to the parent under Python 2.
+                parts = pool.map_async(_count_files_star, jobs).get(1 << 31)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        merge_files(parts, opts.output)
+    finally:
+        shutil.rmtree(tmp_dir)
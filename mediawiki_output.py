@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+
+import logging
+logger = logging.getLogger("mwparser.output")
+
+import os
+import gzip
+import bz2
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import TestCase
+from Queue import Queue
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+
+def _open_gzip(path):
+    return gzip.open(path, 'wb')
+
+def _open_bz2(path):
+    return bz2.BZ2File(path, 'wb')
+
+def _open_xz(path):
+    return lzma.LZMAFile(path, 'wb')
+
+def _open_plain(path):
+    return open(path, 'wb')
+
+# name -> (file suffix, opener)
+COMPRESSIONS = {
+    'gzip': ('.gz', _open_gzip),
+    'bz2': ('.bz2', _open_bz2),
+    'none': ('', _open_plain),
+}
+if lzma is not None:
+    COMPRESSIONS['xz'] = ('.xz', _open_xz)
+
+
+class UnknownCompression(Exception):
+    pass
+
+
+class CheckpointMismatch(Exception):
+    pass
+
+
+class _Shard(object):
+    def __init__(self, index, path):
+        self.index = index
+        self.path = path
+        self.chunks = []
+        self.size = 0
+        self.entries = []
+        self.mark = None
+
+
+class ShardedWriter(object):
+    '''Write pages of plaintext into size-bounded, compressed shards.
+
+    Pages are buffered in memory until the current shard reaches
+    shard_size bytes (uncompressed), after which the shard is handed to
+    a pool of background threads for compression and a new shard is
+    started. Every page is terminated with a newline, so shards can be
+    read without the manifest. The manifest records, per page, the shard
+    file and the uncompressed byte offset and length (newline included)
+    of the page within that shard.
+    Rows are appended in shard order, and only once the shard file is in
+    place.
+
+    A fresh writer replaces any manifest and shards already in directory.
+    Passing a dict previously returned by state() instead continues a
+    run: the manifest is truncated back to that point and any shards
+    written after it are removed.
+
+    If on_commit is given it is called, from a compression thread and in
+    shard order, as on_commit(mark, state) once a shard's manifest rows
+    are on disk. mark is the one passed with the shard's last page and
+    state is the position to resume from after that shard.
+    '''
+
+    def __init__(self, directory, prefix=u'shard', shard_size=64 * 1024 * 1024,
+                 compression='gzip', workers=2, state=None, on_commit=None):
+        if compression not in COMPRESSIONS:
+            raise UnknownCompression(compression)
+        if workers < 1:
+            raise ValueError("workers must be at least 1, not %r" % workers)
+        if shard_size < 1:
+            raise ValueError("shard_size must be at least 1, not %r" % shard_size)
+        self.directory = directory
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.compression = compression
+        self.on_commit = on_commit
+        self.suffix, self.opener = COMPRESSIONS[compression]
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        manifest_path = os.path.join(directory, prefix + u'.manifest')
+        self.next_index = 0
+        if state is not None:
+            self._restore(manifest_path, state)
+            self.manifest = open(manifest_path, 'ab')
+            # tell() on a fresh append-mode file may report 0; state() relies on it.
+            self.manifest.seek(0, os.SEEK_END)
+        else:
+            self._remove_shards(0)
+            self.manifest = open(manifest_path, 'wb')
+
+        # Shards may finish compressing out of order; their manifest rows
+        # wait in self.finished until every earlier shard is done.
+        self.lock = threading.Lock()
+        self.finished = {}
+        self.next_commit = self.next_index
+
+        # Bounded so that a slow compressor cannot buffer the whole corpus.
+        self.queue = Queue(maxsize=workers * 2)
+        self.errors = []
+        self.threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._compress_loop)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+        self.shard = None
+        self.discarding = False
+        self.closed = False
+
+    def shard_path(self, index):
+        name = u'%s-%05i.txt%s' % (self.prefix, index, self.suffix)
+        return os.path.join(self.directory, name)
+
+    def write_page(self, page_id, text, mark=None):
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+        if not text.endswith('\n'):
+            text += '\n'
+        if self.shard is None:
+            self.shard = _Shard(self.next_index, self.shard_path(self.next_index))
+            self.next_index += 1
+
+        shard = self.shard
+        shard.entries.append((page_id, shard.size, len(text)))
+        shard.chunks.append(text)
+        shard.size += len(text)
+        shard.mark = mark
+
+        if shard.size >= self.shard_size:
+            self.rotate()
+
+    def rotate(self):
+        '''Close the current shard and queue it for compression.'''
+        shard = self.shard
+        if shard is None:
+            return
+        self.shard = None
+
+        self._check_errors()
+        self.queue.put(shard)
+
+    def _commit(self, shard):
+        '''Record a shard that is in place, plus any later ones now unblocked.'''
+        with self.lock:
+            self.finished[shard.index] = shard
+            while self.next_commit in self.finished:
+                shard = self.finished.pop(self.next_commit)
+                name = os.path.basename(shard.path)
+                for page_id, offset, length in shard.entries:
+                    line = u'%s\t%s\t%i\t%i\n' % (page_id, name, offset, length)
+                    self.manifest.write(line.encode('utf-8'))
+                self.manifest.flush()
+                self.next_commit += 1
+                if self.on_commit is not None:
+                    os.fsync(self.manifest.fileno())
+                    self.on_commit(shard.mark, self._state())
+
+    def flush(self):
+        '''Rotate and block until every queued shard is on disk.'''
+        self.rotate()
+        self.queue.join()
+        self._check_errors()
+        os.fsync(self.manifest.fileno())
+
+    def state(self):
+        '''Return a resumable position; only meaningful right after flush().'''
+        with self.lock:
+            return self._state()
+
+    def _state(self):
+        return {'next_shard': self.next_commit,
+                'manifest_size': self.manifest.tell(),
+                'prefix': self.prefix,
+                'compression': self.compression,
+                'shard_size': self.shard_size}
+
+    def _restore(self, manifest_path, state):
+        for key in ('prefix', 'compression', 'shard_size'):
+            if state.get(key) != getattr(self, key):
+                raise CheckpointMismatch("Checkpoint was written with %s=%r, not %r" %
+                                         (key, state.get(key), getattr(self, key)))
+        if not os.path.exists(manifest_path) or \
+                os.path.getsize(manifest_path) < state['manifest_size']:
+            raise CheckpointMismatch("Manifest %s is missing or shorter than "
+                                     "the checkpoint" % manifest_path)
+
+        self.next_index = state['next_shard']
+        with open(manifest_path, 'r+b') as f:
+            f.truncate(state['manifest_size'])
+
+        # Drop shards written after the checkpoint; they would otherwise
+        # be overwritten with different content or left dangling.
+        self._remove_shards(self.next_index)
+
+    def _remove_shards(self, first):
+        head = self.prefix + u'-'
+        for name in os.listdir(self.directory):
+            if not name.startswith(head):
+                continue
+            try:
+                index = int(name[len(head):].split(u'.', 1)[0])
+            except ValueError:
+                continue
+            if index >= first or name.endswith(u'.tmp'):
+                os.remove(os.path.join(self.directory, name))
+
+    def close(self, discard=False):
+        '''Finish writing, or with discard drop everything not yet compressed.'''
+        if self.closed:
+            return
+        try:
+            if discard:
+                self.shard = None
+                self.discarding = True
+            else:
+                self.flush()
+        finally:
+            for t in self.threads:
+                self.queue.put(None)
+            for t in self.threads:
+                t.join()
+            self.manifest.close()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def _check_errors(self):
+        if self.errors:
+            raise self.errors[0]
+
+    def _compress_loop(self):
+        while True:
+            shard = self.queue.get()
+            try:
+                if shard is None:
+                    return
+                if not self.discarding:
+                    self._compress(shard)
+            except Exception, e:
+                logger.exception("Compressing %s failed", shard.path)
+                self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    def _compress(self, shard):
+        # Write under a temporary name so that a partial shard is never
+        # mistaken for a finished one.
+        tmp_path = shard.path + u'.tmp'
+        f = self.opener(tmp_path)
+        try:
+            for chunk in shard.chunks:
+                f.write(chunk)
+        finally:
+            f.close()
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.rename(tmp_path, shard.path)
+        logger.debug("Wrote %s (%i bytes uncompressed)", shard.path, shard.size)
+        self._commit(shard)
+
+
+def read_manifest(path):
+    '''Yield (page_id, shard name, offset, length) tuples from a manifest.'''
+    with open(path, 'rb') as f:
+        for line in f:
+            page_id, name, offset, length = line.decode('utf-8').rstrip(u'\n').split(u'\t')
+            yield page_id, name, int(offset), int(length)
+
+
+#
+# Tests
+#
+class ShardedWriterTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def read_shard(self, name):
+        path = os.path.join(self.dir, name)
+        if path.endswith('.gz'):
+            f = gzip.open(path, 'rb')
+        elif path.endswith('.bz2'):
+            f = bz2.BZ2File(path, 'rb')
+        else:
+            f = open(path, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_rotation(self):
+        with ShardedWriter(self.dir, shard_size=10) as w:
+            w.write_page(u'a', u'012345678')
+            w.write_page(u'b', u'ab')
+            w.write_page(u'c', u'cdefghi')
+            w.write_page(u'd', u'm')
+
+        names = sorted(n for n in os.listdir(self.dir) if n.endswith('.gz'))
+        self.assertEqual(names, [u'shard-00000.txt.gz', u'shard-00001.txt.gz',
+                                 u'shard-00002.txt.gz'])
+        self.assertEqual(self.read_shard(names[1]), 'ab\ncdefghi\n')
+
+    def test_page_separator(self):
+        with ShardedWriter(self.dir) as w:
+            w.write_page(u'c', u'Alpha beta')
+            w.write_page(u'e', u'Gamma\n')
+        self.assertEqual(self.read_shard(u'shard-00000.txt.gz'), 'Alpha beta\nGamma\n')
+        manifest = list(read_manifest(os.path.join(self.dir, u'shard.manifest')))
+        self.assertEqual([m[2:] for m in manifest], [(0, 11), (11, 6)])
+
+    def test_manifest_offsets(self):
+        pages = [(u'foo', u'Foo text.\n'), (u'bar', u'Bär text.\n'),
+                 (u'baz', u'Baz.\n')]
+        with ShardedWriter(self.dir, shard_size=15, compression='bz2') as w:
+            for page_id, text in pages:
+                w.write_page(page_id, text)
+
+        manifest = list(read_manifest(os.path.join(self.dir, u'shard.manifest')))
+        self.assertEqual([m[0] for m in manifest], [u'foo', u'bar', u'baz'])
+        for (page_id, text), (_, name, offset, length) in zip(pages, manifest):
+            data = self.read_shard(name)
+            self.assertEqual(data[offset:offset + length].decode('utf-8'), text)
+
+    def test_resume_from_state(self):
+        w = ShardedWriter(self.dir, shard_size=100)
+        w.write_page(u'a', u'aaa')
+        w.flush()
+        state = w.state()
+        w.write_page(u'b', u'bbb')
+        w.close()
+
+        with ShardedWriter(self.dir, shard_size=100, state=state) as w:
+            w.write_page(u'c', u'ccc')
+
+        names = sorted(n for n in os.listdir(self.dir) if n.endswith('.gz'))
+        self.assertEqual(names, [u'shard-00000.txt.gz', u'shard-00001.txt.gz'])
+        self.assertEqual(self.read_shard(names[1]), 'ccc\n')
+        manifest = list(read_manifest(os.path.join(self.dir, u'shard.manifest')))
+        self.assertEqual([m[0] for m in manifest], [u'a', u'c'])
+
+    def test_fresh_start_replaces_output(self):
+        with ShardedWriter(self.dir) as w:
+            w.write_page(u'a', u'aaa')
+            w.rotate()
+            w.write_page(u'b', u'bbb')
+        with ShardedWriter(self.dir) as w:
+            w.write_page(u'c', u'ccc')
+
+        names = sorted(n for n in os.listdir(self.dir) if n.endswith('.gz'))
+        self.assertEqual(names, [u'shard-00000.txt.gz'])
+        self.assertEqual(self.read_shard(names[0]), 'ccc\n')
+        manifest = list(read_manifest(os.path.join(self.dir, u'shard.manifest')))
+        self.assertEqual([m[0] for m in manifest], [u'c'])
+
+    def test_failed_shard_not_in_manifest(self):
+        def failing_opener(path):
+            raise IOError("disk full")
+        w = ShardedWriter(self.dir, workers=1)
+        w.opener = failing_opener
+        w.write_page(u'a', u'aaa')
+        self.assertRaises(IOError, w.flush)
+        self.assertEqual(os.path.getsize(os.path.join(self.dir, u'shard.manifest')), 0)
+        self.assertRaises(IOError, w.close)
+        self.assertTrue(w.manifest.closed)
+        self.assertFalse(any(t.is_alive() for t in w.threads))
+
+    def test_resume_checks_settings(self):
+        with ShardedWriter(self.dir) as w:
+            w.write_page(u'a', u'aaa')
+            w.flush()
+            state = w.state()
+
+        self.assertRaises(CheckpointMismatch, ShardedWriter, self.dir,
+                          compression='bz2', state=state)
+        os.remove(os.path.join(self.dir, u'shard.manifest'))
+        self.assertRaises(CheckpointMismatch, ShardedWriter, self.dir,
+                          state=state)
+
+    def test_on_commit(self):
+        commits = []
+        with ShardedWriter(self.dir, shard_size=3, workers=3,
+                           on_commit=lambda m, s: commits.append((m, s['next_shard']))) as w:
+            for i in range(5):
+                w.write_page(u'p%i' % i, u'xyz', mark=i)
+        self.assertEqual(commits, [(i, i + 1) for i in range(5)])
+
+    def test_close_discard(self):
+        w = ShardedWriter(self.dir)
+        w.write_page(u'a', u'aaa')
+        w.close(discard=True)
+        self.assertEqual([n for n in os.listdir(self.dir) if n.endswith('.gz')], [])
+
+    def test_invalid_settings(self):
+        self.assertRaises(ValueError, ShardedWriter, self.dir, workers=0)
+        self.assertRaises(ValueError, ShardedWriter, self.dir, shard_size=0)
+
+    def test_unknown_compression(self):
+        self.assertRaises(UnknownCompression, ShardedWriter, self.dir,
+                          compression='zip')
+
+
+if __name__ == '__main__':
+    unittest.main()
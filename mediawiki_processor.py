@@ -278,6 +278,17 @@ class MWProcessor(object):
             if no_yield is False:
                 yield token
 
+def plaintext(token_stream):
+    '''Render processed tokens as text, collapsing runs of blank lines.'''
+    newlines = 0
+    for token in token_stream:
+        if isinstance(token, NewLine):
+            newlines += 1
+        else:
+            newlines = 0
+        if newlines < 3:
+            yield token.text
+
 def y(seq):
     '''Helper function to make a list into a generator.'''
     for i in seq:
@@ -323,9 +334,14 @@ class ProcessorTest(TestCase):
         out = list(self.p.process(y(data)))
         self.assertEquals(len(out), 2)
 
+    def test_plaintext_collapses_newlines(self):
+        data = [Word(u"foo")] + [NewLine(u'\n')] * 5 + [Word(u"bar")]
+        self.assertEqual(u''.join(plaintext(y(data))), u"foo\n\nbar")
+
 
 if __name__ == '__main__':
     from optparse import OptionParser
+    from mediawiki_output import COMPRESSIONS
 
     parser = OptionParser()
     parser.add_option("-d", "--debug", dest="debug",
@@ -334,13 +350,53 @@ if __name__ == '__main__':
     parser.add_option("-s", "--state", dest="state",
                       help="print state",
                       action="store_true", default=False)
+    parser.add_option("-o", "--output-dir", dest="output_dir",
+                      help="write pages to compressed shards in DIR "
+                      "instead of stdout", metavar="DIR", default=None)
+    parser.add_option("--shard-size", dest="shard_size", type="int",
+                      help="target uncompressed shard size in bytes",
+                      default=64 * 1024 * 1024)
+    parser.add_option("--compression", dest="compression", type="choice",
+                      choices=sorted(COMPRESSIONS),
+                      help="shard compression: %s" % ", ".join(sorted(COMPRESSIONS)),
+                      default="gzip")
+    parser.add_option("--compress-workers", dest="compress_workers",
+                      type="int", help="background compression threads",
+                      default=2)
+    parser.add_option("--checkpoint", dest="checkpoint",
+                      help="checkpoint file for resuming an interrupted "
+                      "--output-dir run (default: DIR/checkpoint.json)",
+                      metavar="FILE", default=None)
+    parser.add_option("--checkpoint-every", dest="checkpoint_every",
+                      type="int", help="shards between checkpoints",
+                      default=1)
     (opts, args) = parser.parse_args()
     if opts.state:
         _print_state = True
+    if opts.output_dir is not None and opts.debug:
+        parser.error("--output-dir cannot be combined with --debug")
+    if opts.shard_size < 1:
+        parser.error("--shard-size must be at least 1")
+    if opts.compress_workers < 1:
+        parser.error("--compress-workers must be at least 1")
+    if opts.checkpoint_every < 1:
+        parser.error("--checkpoint-every must be at least 1")
 
     if len(args) == 0:
         unittest.main()
 
+    if opts.output_dir is not None:
+        from mediawiki_batch import BatchRunner
+        runner = BatchRunner(args, opts.output_dir,
+                             checkpoint_path=opts.checkpoint,
+                             checkpoint_every=opts.checkpoint_every,
+                             shard_size=opts.shard_size,
+                             compression=opts.compression,
+                             workers=opts.compress_workers)
+        stats = runner.run()
+        print >> sys.stderr, "Wrote %i pages in %f seconds." % (stats['pages'], stats['seconds'])
+        sys.exit(0)
+
     for item in args:
         with codecs.open(item, 'r', encoding='utf-8') as f:
             a = MWProcessor()
@@ -349,14 +405,8 @@ if __name__ == '__main__':
             contents = f.read()
 
             if not opts.debug:
-                newlines = 0
-                for token in a.process(tokenize(contents, tokens())):
-                    if isinstance(token, NewLine):
-                        newlines += 1
-                    else:
-                        newlines = 0
-                    if newlines < 3:
-                        sys.stdout.write(token.text)
+                for chunk in plaintext(a.process(tokenize(contents, tokens()))):
+                    sys.stdout.write(chunk)
                 continue
 
             toks = []
@@ -375,4 +425,3 @@ if __name__ == '__main__':
             print "Processing time: %f seconds." % secs
 
 
-